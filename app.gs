@@ -116,7 +116,7 @@ function doPost(e) {
   const apiKey = PropertiesService.getScriptProperties().getProperty('GAS_API_KEY');
   let payload = {};
   try {
-    payload = JSON.parse(e.postData && e.postData.contents ? e.postData.contents : '{}');
+    payload = parsePostBody_(e.postData && e.postData.contents ? e.postData.contents : '{}');
   } catch (err) {
     return ContentService.createTextOutput('Invalid JSON').setMimeType(ContentService.MimeType.TEXT).setResponseCode(400);
   }
@@ -129,6 +129,18 @@ function doPost(e) {
     return ContentService.createTextOutput('No rows');
   }
 
+  // スクレイパーはバッチを並列POSTするため、重複チェック〜追記を
+  // ロックで直列化しないと getLastRow() が競合して行を上書きし合う
+  const lock = LockService.getScriptLock();
+  lock.waitLock(30000);
+  try {
+    return appendRows_(items);
+  } finally {
+    lock.releaseLock();
+  }
+}
+
+function appendRows_(items) {
   const sheet = getSheet_();
   const appendValues = [];
   items.forEach((item) => {
@@ -170,6 +182,16 @@ function doPost(e) {
   return ContentService.createTextOutput(`ok:${appendValues.length}`);
 }
 
+function parsePostBody_(raw) {
+  const text = String(raw).trim();
+  // スクレイパーは gzip した JSON を base64 で包んで送る（素の JSON の場合はそのまま解析）
+  if (text.charAt(0) === '{' || text.charAt(0) === '[') {
+    return JSON.parse(text);
+  }
+  const blob = Utilities.newBlob(Utilities.base64Decode(text), 'application/x-gzip');
+  return JSON.parse(Utilities.ungzip(blob).getDataAsString('UTF-8'));
+}
+
 function normalizeTime_(value) {
   if (!value) {
     return '';
@@ -6,16 +6,27 @@
 #  - 取得結果を Excel（Raw / ActiveSlots / T_Slot）へ出力
 
 import argparse
+import asyncio
+import base64
+import csv
+import functools
+import gzip
+import logging
 import os
 import sys
 import re
-import time
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field, is_dataclass
 from datetime import date, timedelta
 from typing import Dict, List, Tuple, Optional
 
+import aiohttp
+import lxml.html
+from lxml.etree import XPath
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import numpy as np
 import pandas as pd
 
 try:
@@ -23,6 +34,27 @@ try:
 except Exception:
     tomllib = None
 
+import json
+
+try:
+    import orjson  # C実装で数倍速い（bytesを直接返す）
+except ImportError:
+    orjson = None
+
+
+def _json_default(obj):
+    if is_dataclass(obj):
+        return asdict(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _json_dumps(obj) -> bytes:
+    """orjsonがあればそれで、なければstdlib jsonでUTF-8 bytesにシリアライズする"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"),
+                      default=_json_default).encode("utf-8")
+
 
 DEFAULT_LOGIN_URL = "https://www.o-za.jp/oza/AdminLogin.aspx"   # ← ルート直下
 DEFAULT_BASE_ADMIN = "https://www.o-za.jp/oza/AdminArea/"       # ← AdminArea配下用
@@ -31,6 +63,34 @@ DEFAULT_CLOCK_URL      = DEFAULT_BASE_ADMIN + "ClockInOut.aspx"
 DEFAULT_USER = "5uz.xxxaoi@gmail.com"
 DEFAULT_PASS = "hN5keQGc"   # ⚠ 実運用では環境変数/安全な保管方法を推奨
 
+# ループ内で使う正規表現はモジュールロード時に一度だけコンパイルする
+_HHMM_RE = re.compile(r"[^0-9]")
+_CALL_PLAN_RE = re.compile(r"callPlanDetail\('([^']+)','([^']+)','([^']+)','([^']+)','([^']+)'\)")
+_START_TIME_RE = re.compile(r"(\d{1,2}:\d{2})")
+
+# 開始時刻→終了時刻の固定マッピング（それ以外は開始+50分）
+_END_TIME_MAP = {"16:05": "16:55", "17:00": "17:50", "17:55": "18:45"}
+
+# 「授業予定はありません」のUTF-8バイト列（デコード前の応答本文を直接判定する）
+_NO_CLASS_MARKER = "授業予定はありません".encode("utf-8")
+
+# 生徒出欠テーブルの列インデックス（No, 学年, 生徒ID, 名前, チェック, 出欠状態, ..., 備考）
+_STUDENT_ID_IDX = 2
+_STUDENT_NAME_IDX = 3
+_STUDENT_CHK_IDX = 4
+_STUDENT_STATUS_IDX = 5
+_STUDENT_MEMO_IDX = 8
+
+# 繰り返し評価するXPathはコンパイル済みオブジェクトとして使い回す
+_XP_DATALISTS = XPath('//table[@id="TblDataList"]')
+_XP_SCHOOL_DDL = XPath('//select[@id="ctl00_CPH_ddlSeachSchoolID"]')
+_XP_SELECTED_SCHOOL = XPath('//select[@id="ctl00_CPH_ddlSeachSchoolID"]/option[@selected]')
+_XP_HIDDEN_INPUTS = XPath('//input[@type="hidden"]')
+_XP_ROWS = XPath('.//tr')
+_XP_CHECKED_BOX = XPath('.//input[@type="checkbox" and @checked]')
+
+logger = logging.getLogger(__name__)
+
 
 @dataclass
 class Config:
@@ -47,6 +107,41 @@ class Config:
     user_agent: str = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) OZA-PayrollScraper/2.0"
 
 
+@dataclass(slots=True)
+class Student:
+    # 生徒1人分の出欠（dictより軽量・省メモリ。シリアライズ境界でのみdict化する）
+    name: str
+    student_id: str
+    is_attended: bool
+    status: str
+    memo: str
+
+
+@dataclass(slots=True)
+class Detail:
+    """クラス1コマ分の詳細（講師・出欠集計・生徒リスト）
+
+    ホットループで .get(キー) のハッシュ計算を払わずに済むよう、
+    dictではなくslots付きデータクラスで持つ。
+    """
+    teacher_id: Optional[str] = None
+    teacher_name: Optional[str] = None
+    teacher_attendance: Optional[str] = None
+    teacher_memo: Optional[str] = None
+    attendance_count: int = 0
+    attendance_count_regular: int = 0
+    attendance_count_substitution: int = 0
+    substitution_count: int = 0  # 後方互換性のため残す
+    absent_count: int = 0
+    class_name: Optional[str] = None
+    date: Optional[str] = None
+    start_time: Optional[str] = None
+    school_name: Optional[str] = None
+    school_id: Optional[str] = None
+    course_id: Optional[int] = None
+    students: List[Student] = field(default_factory=list)
+
+
 def yyyymm_to_range(yyyy_mm: str) -> Tuple[date, date]:
     if "-" in yyyy_mm:
         y, m = yyyy_mm.split("-", 1)
@@ -67,18 +162,35 @@ def resolve_month_arg(value: Optional[str]) -> str:
     return value
 
 
-def extract_hidden_fields(soup: BeautifulSoup) -> Dict[str, str]:
+# サイトはUTF-8固定。bytesはこのパーサで直接デコードし、charset推定を省く
+_UTF8_HTML_PARSER = lxml.html.HTMLParser(encoding="utf-8")
+
+
+def _parse(html) -> lxml.html.HtmlElement:
+    """HTML（str/bytes）を lxml ツリーに変換する（パース済みツリーはそのまま返す）
+
+    bytesはUTF-8指定のパーサでそのまま処理するため、requests/aiohttpの
+    charset推定（charset_normalizer）を経由せずに済む。
+    """
+    if isinstance(html, bytes):
+        return lxml.html.fromstring(html, parser=_UTF8_HTML_PARSER)
+    if isinstance(html, str):
+        return lxml.html.fromstring(html)
+    return html
+
+
+def extract_hidden_fields(root: lxml.html.HtmlElement) -> Dict[str, str]:
     data = {}
-    for inp in soup.select("input[type=hidden]"):
+    for inp in _XP_HIDDEN_INPUTS(root):
         name = inp.get("name")
         if name:
             data[name] = inp.get("value", "")
     return data
 
 
-def aspnet_post(session: requests.Session, url: str, soup: BeautifulSoup,
+def aspnet_post(session: requests.Session, url: str, root: lxml.html.HtmlElement,
                 event_target: str = "", event_argument: str = "", extra_form: dict = None):
-    payload = extract_hidden_fields(soup)
+    payload = extract_hidden_fields(root)
     if event_target:
         payload["__EVENTTARGET"] = event_target
     if event_argument is not None:
@@ -90,20 +202,38 @@ def aspnet_post(session: requests.Session, url: str, soup: BeautifulSoup,
     return resp
 
 
+def make_session(cfg: Config) -> requests.Session:
+    """リトライ・コネクションプール設定済みの requests.Session を作る"""
+    s = requests.Session()
+    # コネクションプール拡張＋一時的な5xx/接続エラーはリトライ（keep-alive/gzipで転送量も削減）
+    retry = Retry(total=3, backoff_factor=0.3, status_forcelist=(500, 502, 503, 504),
+                  allowed_methods=frozenset(["GET", "POST"]))
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=retry)
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    s.headers.update({
+        "User-Agent": cfg.user_agent,
+        "Connection": "keep-alive",
+        "Accept-Encoding": "gzip, deflate",
+    })
+    return s
+
+
 def login(session: requests.Session, cfg: Config, verbose: bool = True) -> bool:
     r = session.get(cfg.login_url)
     r.raise_for_status()
-    soup = BeautifulSoup(r.text, "lxml")
+    root = _parse(r.content)
     extra = {
         cfg.user_field: cfg.username,
         cfg.pass_field: cfg.password,
     }
-    resp = aspnet_post(session, cfg.login_url, soup,
+    resp = aspnet_post(session, cfg.login_url, root,
                        event_target=cfg.login_button,
                        event_argument="",
                        extra_form=extra)
     if verbose:
         print(f"[login] status={resp.status_code} url={resp.url}")
+    resp.encoding = resp.encoding or "utf-8"  # charset推定を走らせない
     ok = ("btnLogout" in resp.text) or ("ログアウト" in resp.text) or ("/AdminArea/" in resp.url)
     if verbose:
         print(f"[login] success? {ok}")
@@ -116,91 +246,91 @@ def click_work_end(session: requests.Session, cfg: Config, verbose: bool = True)
     if r.status_code != 200:
         if verbose: print(f"[work_end] GET failed: {r.status_code}")
         return False
-    soup = BeautifulSoup(r.text, "lxml")
+    root = _parse(r.content)
     target = "ctl00$btnWorkEnd"
-    if not soup.find(id="ctl00_btnWorkEnd"):
+    if root.get_element_by_id("ctl00_btnWorkEnd", None) is None:
         # 代替: 出欠ページでもヘッダにボタンがあれば押下
         r2 = session.get(cfg.attendance_url)
         if r2.status_code != 200:
             if verbose: print(f"[work_end] alt GET failed: {r2.status_code}")
             return False
-        soup = BeautifulSoup(r2.text, "lxml")
-        if not soup.find(id="ctl00_btnWorkEnd"):
+        root = _parse(r2.content)
+        if root.get_element_by_id("ctl00_btnWorkEnd", None) is None:
             if verbose: print("[work_end] btn not found; skip")
             return False
         post_url = cfg.attendance_url
     else:
         post_url = cfg.clock_url
 
-    resp = aspnet_post(session, post_url, soup, event_target=target, event_argument="")
+    resp = aspnet_post(session, post_url, root, event_target=target, event_argument="")
     if verbose:
         print(f"[work_end] post status={resp.status_code}")
     return True
 
 
-def open_attendance(session: requests.Session, cfg: Config) -> BeautifulSoup:
+def open_attendance(session: requests.Session, cfg: Config) -> lxml.html.HtmlElement:
     r = session.get(cfg.attendance_url)
     r.raise_for_status()
-    return BeautifulSoup(r.text, "lxml")
+    return _parse(r.content)
 
 
-def change_course(session: requests.Session, cfg: Config, soup: BeautifulSoup, course_id: int) -> BeautifulSoup:
+def change_course(session: requests.Session, cfg: Config, root: lxml.html.HtmlElement, course_id: int) -> lxml.html.HtmlElement:
     # ブランドDDLの変更ポストバック模倣
     extra = {
         "ctl00$CPH$ddlSeachCourseID": str(course_id),
         "ctl00$CPH$txtSeachCGP_INDEX": "ALL",
     }
-    resp = aspnet_post(session, cfg.attendance_url, soup,
+    resp = aspnet_post(session, cfg.attendance_url, root,
                        event_target="ctl00$CPH$ddlSeachCourseID",
                        event_argument="",
                        extra_form=extra)
-    return BeautifulSoup(resp.text, "lxml")
+    return _parse(resp.content)
 
 
-def parse_school_options_from_soup(soup: BeautifulSoup) -> List[Tuple[str, str]]:
+def parse_school_options_from_soup(root: lxml.html.HtmlElement) -> List[Tuple[str, str]]:
     options = []
-    ddl = soup.select_one("select#ctl00_CPH_ddlSeachSchoolID")
-    if not ddl:
+    ddls = _XP_SCHOOL_DDL(root)
+    if not ddls:
         return options
-    for opt in ddl.select("option"):
+    # <option>は子要素を持たないので .text 直読みで十分（text_contentの子孫走査を省く）
+    for opt in ddls[0].iter("option"):
         val = (opt.get("value") or "").strip()
-        txt = (opt.get_text() or "").strip()
         if val:
-            options.append((val, txt))
+            options.append((val, (opt.text or "").strip()))
     return options
 
 
-def parse_attendance_table(html: str) -> List[dict]:
-    soup = BeautifulSoup(html, "lxml")
-    table = soup.find("table", id="TblDataList")
-    if not table:
+def parse_attendance_table(html) -> List[dict]:
+    root = _parse(html)
+    table = root.get_element_by_id("TblDataList", None)
+    if table is None:
         return []
     school_name = None
-    ddl = soup.select_one("select#ctl00_CPH_ddlSeachSchoolID option[selected]")
-    if ddl:
-        school_name = ddl.get_text(strip=True)
+    selected = _XP_SELECTED_SCHOOL(root)
+    if selected:
+        school_name = selected[0].text_content().strip()
 
     rows = []
-    trs = table.find_all("tr")
+    trs = _XP_ROWS(table)
     if len(trs) <= 2:
         # 「授業予定はありません」等
         return rows
     for tr in trs[2:]:
-        tds = tr.find_all("td")
+        tds = tr.findall("td")
         if len(tds) != 6:
             continue
-        limit_name = tds[0].get_text(strip=True)
-        start_label = tds[1].get_text(strip=True)  # "1605～"
-        title = tds[2].get_text(strip=True)
+        limit_name = tds[0].text_content().strip()
+        start_label = tds[1].text_content().strip()  # "1605～"
+        title = tds[2].text_content().strip()
         try:
-            expected = int(tds[3].get_text(strip=True) or 0)
+            expected = int(tds[3].text_content().strip() or 0)
         except:
             expected = 0
         try:
-            trial = int(tds[4].get_text(strip=True) or 0)
+            trial = int(tds[4].text_content().strip() or 0)
         except:
             trial = 0
-        hhmm = re.sub(r"[^0-9]", "", start_label)
+        hhmm = _HHMM_RE.sub("", start_label)
         if len(hhmm) >= 3:
             hh = int(hhmm[:-2]); mm = int(hhmm[-2:])
             start_time = f"{hh:02d}:{mm:02d}"
@@ -219,82 +349,56 @@ def parse_attendance_table(html: str) -> List[dict]:
     return rows
 
 
-def parse_class_detail(html: str) -> dict:
+def parse_class_detail(html) -> Detail:
     """
     クラス詳細ページ (toDayAttendanceDetail.aspx) から講師情報と生徒出欠情報を抽出
 
     Returns:
-        dict: {
-            "teacher_id": str,
-            "teacher_name": str,
-            "teacher_attendance": str,  # 講師出席状態（出席/欠席）
-            "attendance_count": int,  # 出席人数（合計）
-            "attendance_count_regular": int,  # 通常出席人数（振替なし）
-            "attendance_count_substitution": int,  # 振替出席人数
-            "absent_count": int,  # 欠席人数
-            "class_name": str,
-            "date": str,
-            "start_time": str,
-            "school_name": str,
-            "students": List[dict]  # 各生徒の詳細情報
-        }
+        Detail: 講師情報（teacher_id/teacher_name/teacher_attendance/teacher_memo）、
+            出欠集計（attendance_count とその内訳、absent_count）、
+            クラス基本情報（class_name/date/start_time/school_name）、
+            および students（各生徒の Student のリスト）を持つ
     """
-    soup = BeautifulSoup(html, "lxml")
-    result = {
-        "teacher_id": None,
-        "teacher_name": None,
-        "teacher_attendance": None,
-        "teacher_memo": None,
-        "attendance_count": 0,
-        "attendance_count_regular": 0,
-        "attendance_count_substitution": 0,
-        "substitution_count": 0,  # 後方互換性のため残す
-        "absent_count": 0,
-        "class_name": None,
-        "date": None,
-        "start_time": None,
-        "school_name": None,
-        "students": []
-    }
+    root = _parse(html)
+    result = Detail()
 
     # クラス基本情報を取得
-    class_name_span = soup.find("span", id="ctl00_CPH_lblClassGroupName")
-    if class_name_span:
-        result["class_name"] = class_name_span.get_text(strip=True)
+    class_name_span = root.get_element_by_id("ctl00_CPH_lblClassGroupName", None)
+    if class_name_span is not None:
+        result.class_name = class_name_span.text_content().strip()
 
-    date_span = soup.find("span", id="ctl00_CPH_lblPlanDate")
-    if date_span:
-        result["date"] = date_span.get_text(strip=True)
+    date_span = root.get_element_by_id("ctl00_CPH_lblPlanDate", None)
+    if date_span is not None:
+        result.date = date_span.text_content().strip()
 
-    time_span = soup.find("span", id="ctl00_CPH_lblStartRealTime")
-    if time_span:
-        result["start_time"] = time_span.get_text(strip=True)
+    time_span = root.get_element_by_id("ctl00_CPH_lblStartRealTime", None)
+    if time_span is not None:
+        result.start_time = time_span.text_content().strip()
 
-    school_span = soup.find("span", id="ctl00_CPH_lblSchoolName")
-    if school_span:
-        result["school_name"] = school_span.get_text(strip=True)
+    school_span = root.get_element_by_id("ctl00_CPH_lblSchoolName", None)
+    if school_span is not None:
+        result.school_name = school_span.text_content().strip()
 
     # 講師情報と生徒情報を取得（複数のTblDataListがある）
-    all_tables = soup.find_all("table", id="TblDataList")
+    all_tables = _XP_DATALISTS(root)
 
     # 講師情報を取得（最初のTblDataList）
     if all_tables:
         teacher_table = all_tables[0]
-        teacher_rows = teacher_table.find_all("tr")
+        teacher_rows = _XP_ROWS(teacher_table)
         # ヘッダー行をスキップして最初のデータ行から講師名を取得
         for tr in teacher_rows[1:]:
-            # <th>と<td>が混在している場合があるので、両方取得
-            tds = tr.find_all("td")
-            ths = tr.find_all("th")
+            # <th>と<td>が混在している場合があるので、<td>のみ取得
+            tds = tr.findall("td")
 
             # 講師テーブルの構造:
             # <th>講師 1</th> <td>ID:8211256</td> <td>竹内 真奈美</td> <td><checkbox></td> <td>出席</td> ...
             if len(tds) >= 2:
                 # tds[0] = "ID:8211256"
                 # tds[1] = "竹内 真奈美"
-                if "ID:" in tds[0].get_text(strip=True):
+                if "ID:" in tds[0].text_content():
                     # 講師IDを抽出（"ID:8211256" から "8211256" を取り出す）
-                    teacher_id_text = tds[0].get_text(strip=True)
+                    teacher_id_text = tds[0].text_content().strip()
                     # 空白で分割して "ID:" を含む部分を探す
                     teacher_id = None
                     for part in teacher_id_text.split():
@@ -304,93 +408,84 @@ def parse_class_detail(html: str) -> dict:
                     if not teacher_id:
                         # フォールバック：単純にreplaceする
                         teacher_id = teacher_id_text.replace("ID:", "").split()[0].strip()
-                    result["teacher_id"] = teacher_id
+                    result.teacher_id = teacher_id
 
                     # 講師名を取得
-                    teacher_name = tds[1].get_text(strip=True)
+                    teacher_name = tds[1].text_content().strip()
                     if teacher_name and teacher_name != "":
-                        result["teacher_name"] = teacher_name
+                        result.teacher_name = teacher_name
 
                     # 講師の出席状態を取得（tds[3]が出席/欠席のテキスト）
                     if len(tds) >= 4:
-                        result["teacher_attendance"] = tds[3].get_text(strip=True)
+                        result.teacher_attendance = tds[3].text_content().strip()
 
                     # 講師の備考を取得（tds[5]が備考欄の可能性）
                     if len(tds) >= 6:
-                        result["teacher_memo"] = tds[5].get_text(strip=True)
+                        result.teacher_memo = tds[5].text_content().strip()
 
                     # デバッグ出力
-                    print(f"    [DEBUG] 講師情報: ID={result['teacher_id']}, 名前={result['teacher_name']}, 出席={result['teacher_attendance']}, 備考={result['teacher_memo']}")
+                    logger.debug("講師情報: ID=%s, 名前=%s, 出席=%s, 備考=%s",
+                                 result.teacher_id, result.teacher_name,
+                                 result.teacher_attendance, result.teacher_memo)
 
                     break
                 # もしくは別の構造の場合
                 elif len(tds) >= 3:
-                    teacher_name = tds[2].get_text(strip=True)
+                    teacher_name = tds[2].text_content().strip()
                     if teacher_name and teacher_name != "":
-                        result["teacher_name"] = teacher_name
+                        result.teacher_name = teacher_name
                         break
 
     # 生徒出欠情報を取得（2つ目のTblDataList）
     if len(all_tables) >= 2:
         student_table = all_tables[1]
-        student_rows = student_table.find_all("tr")
+        student_rows = _XP_ROWS(student_table)
 
         # ヘッダー行をスキップして生徒データを処理
         for tr in student_rows[1:]:  # 最初の行はヘッダー
-            tds = tr.find_all("td")
+            tds = tr.findall("td")
             if len(tds) < 10:  # 生徒行は多数の列がある
                 continue
 
-            # No, 学年, 生徒ID, 名前, チェックボックス, 出欠状態, ..., 備考
-            student_name = tds[3].get_text(strip=True) if len(tds) > 3 else ""
-            student_id = tds[2].get_text(strip=True) if len(tds) > 2 else ""
-
-            # チェックボックスの状態を確認
-            checkbox_td = tds[4] if len(tds) > 4 else None
-            is_attended = False
-            if checkbox_td:
-                checkbox = checkbox_td.find("input", {"type": "checkbox"})
-                if checkbox and checkbox.get("checked") is not None:
-                    is_attended = True
-
+            # 全セルのテキストを1パスで抽出してからインデックスで参照する
+            texts = ["".join(td.itertext()).strip() for td in tds]
+            student_id = texts[_STUDENT_ID_IDX]
+            student_name = texts[_STUDENT_NAME_IDX]
             # 出欠状態のテキスト（"出席"、"欠席"など）
-            attendance_status = tds[5].get_text(strip=True) if len(tds) > 5 else ""
-
+            attendance_status = texts[_STUDENT_STATUS_IDX]
             # 備考欄（振替などの情報）
-            memo = tds[8].get_text(strip=True) if len(tds) > 8 else ""
+            memo = texts[_STUDENT_MEMO_IDX]
+
+            # チェックボックスの状態を確認
+            is_attended = bool(_XP_CHECKED_BOX(tds[_STUDENT_CHK_IDX]))
 
             # 集計
             if is_attended or attendance_status == "出席":
-                result["attendance_count"] += 1
+                result.attendance_count += 1
                 # 備考に「振替」が含まれている場合
                 if "振替" in memo or "振り替え" in memo:
-                    result["substitution_count"] += 1
-                    result["attendance_count_substitution"] += 1
-                    print(f"      [DEBUG] 生徒振替: {student_name} (備考: {memo})")
+                    result.substitution_count += 1
+                    result.attendance_count_substitution += 1
+                    logger.debug("生徒振替: %s (備考: %s)", student_name, memo)
                 else:
-                    result["attendance_count_regular"] += 1
+                    result.attendance_count_regular += 1
             elif attendance_status == "欠席":
-                result["absent_count"] += 1
-                print(f"      [DEBUG] 生徒欠席: {student_name}")
+                result.absent_count += 1
+                logger.debug("生徒欠席: %s", student_name)
 
             # 生徒詳細情報を保存
-            result["students"].append({
-                "name": student_name,
-                "student_id": student_id,
-                "is_attended": is_attended,
-                "status": attendance_status,
-                "memo": memo
-            })
+            result.students.append(
+                Student(student_name, student_id, is_attended, attendance_status, memo))
 
     return result
 
 
+@functools.lru_cache(maxsize=1024)
 def map_end_time(start_time: Optional[str]) -> Optional[str]:
-    mapping = {"16:05": "16:55", "17:00": "17:50", "17:55": "18:45"}
     if not start_time:
         return None
-    if start_time in mapping:
-        return mapping[start_time]
+    if start_time in _END_TIME_MAP:
+        return _END_TIME_MAP[start_time]
     try:
         hh, mm = map(int, start_time.split(":"))
         total = hh * 60 + mm + 50
@@ -400,32 +495,32 @@ def map_end_time(start_time: Optional[str]) -> Optional[str]:
         return None
 
 
-def fetch_class_detail_links(html: str, base_url: str) -> List[Tuple[str, str]]:
+def fetch_class_detail_links(html, base_url: str) -> List[Tuple[str, str]]:
     """
     出欠一覧ページから各クラスの詳細ページへのリンクを抽出
 
     Returns:
         List[Tuple[str, str]]: [(class_name, detail_url), ...]
     """
-    soup = BeautifulSoup(html, "lxml")
+    root = _parse(html)
     links = []
 
     # TblDataListというIDのテーブルが複数ある可能性があるので、全部取得
     # toDayAttendanceSeach.aspxページのクラス一覧テーブルを探す
     # テーブル構造: 日付区分 | 時間帯 | クラス名 | 本予定人数 | 体験人数 | 合計
-    tables = soup.find_all("table", id="TblDataList")
+    tables = _XP_DATALISTS(root)
 
-    print(f"    [DEBUG] TblDataListテーブル数: {len(tables)}")
+    logger.debug("TblDataListテーブル数: %d", len(tables))
 
     for table_idx, table in enumerate(tables):
-        print(f"    [DEBUG] テーブル {table_idx + 1} を解析中...")
-        rows = table.find_all("tr")
+        logger.debug("テーブル %d を解析中...", table_idx + 1)
+        rows = _XP_ROWS(table)
 
         # 「授業予定はありません」のチェック
         if rows and len(rows) > 1:
-            second_row_text = rows[1].get_text(strip=True)
+            second_row_text = rows[1].text_content().strip()
             if "授業予定はありません" in second_row_text:
-                print(f"    [DEBUG] このテーブルには授業予定がありません。スキップ")
+                logger.debug("このテーブルには授業予定がありません。スキップ")
                 continue
 
         # ヘッダー行を確認
@@ -436,33 +531,33 @@ def fetch_class_detail_links(html: str, base_url: str) -> List[Tuple[str, str]]:
         header_row_idx = None
         if rows and len(rows) > 0:
             for idx, row in enumerate(rows):
-                header_cells = row.find_all("th")
-                header_text = [th.get_text(strip=True) for th in header_cells]
+                header_cells = row.findall("th")
+                header_text = [th.text_content().strip() for th in header_cells]
 
                 if idx == 0:
-                    print(f"    [DEBUG] 行{idx}のヘッダー: {header_text}")
+                    logger.debug("行%dのヘッダー: %s", idx, header_text)
 
                 # クラス名（または「名称」）の列が含まれているかチェック
                 if "クラス名" in header_text or "名称" in header_text:
                     header_row_idx = idx
-                    print(f"    [DEBUG] 行{idx}にクラス一覧のヘッダーを発見: {header_text}")
+                    logger.debug("行%dにクラス一覧のヘッダーを発見: %s", idx, header_text)
                     break
 
         if header_row_idx is None:
-            print(f"    [DEBUG] このテーブルはクラス一覧ではありません。スキップ")
+            logger.debug("このテーブルはクラス一覧ではありません。スキップ")
             continue
 
         # ヘッダー行の次からデータ行を処理
         for row_idx, row in enumerate(rows[header_row_idx + 1:], 1):
-            tds = row.find_all("td")
+            tds = row.findall("td")
             if len(tds) < 3:
                 continue
 
             # クラス名のセル（3列目、インデックス2）からリンクを探す
             class_cell = tds[2]
-            link = class_cell.find("a")
-            if link:
-                class_name = link.get_text(strip=True)
+            link = class_cell.find(".//a")
+            if link is not None:
+                class_name = link.text_content().strip()
 
                 # 2つのリンクパターンに対応
                 # パターン1: <a href="toDayAttendanceDetail.aspx?...">
@@ -470,20 +565,19 @@ def fetch_class_detail_links(html: str, base_url: str) -> List[Tuple[str, str]]:
                 href = link.get("href", "")
                 onclick = link.get("onclick", "")
 
-                print(f"    [DEBUG] リンク発見 (行{row_idx}): クラス名='{class_name}'")
-                print(f"    [DEBUG]   href='{href}', onclick='{onclick}'")
+                logger.debug("リンク発見 (行%d): クラス名='%s'", row_idx, class_name)
+                logger.debug("  href='%s', onclick='%s'", href, onclick)
 
                 detail_url = None
 
                 # JavaScriptのonclick属性からURLを構築
                 if onclick and "callPlanDetail" in onclick:
                     # callPlanDetail('2','4200','1','20251001','1')から引数を抽出
-                    import re
-                    match = re.search(r"callPlanDetail\('([^']+)','([^']+)','([^']+)','([^']+)','([^']+)'\)", onclick)
+                    match = _CALL_PLAN_RE.search(onclick)
                     if match:
                         crsIdx, cgpIdx, sclIdx, planDate, sttTime = match.groups()
                         detail_url = f"{base_url}toDayAttendanceDetail.aspx?crsIdx={crsIdx}&cgpIdx={cgpIdx}&sclIdx={sclIdx}&planDate={planDate}&sttTime={sttTime}"
-                        print(f"    [DEBUG]   JavaScriptから構築したURL: '{detail_url}'")
+                        logger.debug("  JavaScriptから構築したURL: '%s'", detail_url)
 
                 # 通常のhref属性からURL構築
                 elif href and href != "#" and not href.startswith("javascript:"):
@@ -494,46 +588,74 @@ def fetch_class_detail_links(html: str, base_url: str) -> List[Tuple[str, str]]:
                             detail_url = "https://www.o-za.jp" + href
                     else:
                         detail_url = href
-                    print(f"    [DEBUG]   hrefから構築したURL: '{detail_url}'")
+                    logger.debug("  hrefから構築したURL: '%s'", detail_url)
 
                 if detail_url:
                     links.append((class_name, detail_url))
                 else:
-                    print(f"    [DEBUG]   URLを構築できませんでした")
+                    logger.debug("  URLを構築できませんでした")
 
     return links
 
 
-def fetch_class_detail(session: requests.Session, detail_url: str) -> dict:
+async def fetch_class_detail_async(session: aiohttp.ClientSession, sem: asyncio.Semaphore, detail_url: str) -> Detail:
     """
     クラス詳細ページにアクセスして情報を取得
 
     Args:
-        session: requests.Session
+        session: aiohttp.ClientSession
+        sem: 同時リクエスト数を制限するセマフォ
         detail_url: 詳細ページのURL
 
     Returns:
-        dict: parse_class_detail()の戻り値
+        Detail: parse_class_detail()の戻り値
     """
-    resp = session.get(detail_url)
-    resp.raise_for_status()
-    return parse_class_detail(resp.text)
+    async with sem:
+        async with session.get(detail_url) as resp:
+            resp.raise_for_status()
+            body = await resp.read()
+    # bytesのままlxmlへ渡し、aiohttp側のデコードをスキップする
+    return parse_class_detail(body)
 
 
-def fetch_one_day(session: requests.Session, cfg: Config, soup: BeautifulSoup, day: date, course_id: int, school_id: str, fetch_details: bool = False) -> Tuple[List[dict], BeautifulSoup, List[dict]]:
+async def fetch_one_day_async(session: aiohttp.ClientSession, sem: asyncio.Semaphore, cfg: Config,
+                              viewstates: Dict[Tuple[int, str], Dict[str, str]], day: date,
+                              course_id: int, school_id: str,
+                              fetch_details: bool = False) -> Tuple[List[dict], List[Detail]]:
     # 日付/校舎/ブランドをセットして「表示」押下
+    # ViewStateは (course_id, school_id) 単位でキャッシュした隠しフィールドを使い回す
+    key = (course_id, school_id)
     extra = {
+        "__EVENTTARGET": "ctl00$CPH$btnSeach",
+        "__EVENTARGUMENT": "",
         "ctl00$CPH$txtTargetDate": day.strftime("%Y/%m/%d"),
         "ctl00$CPH$ddlSeachCourseID": str(course_id),
         "ctl00$CPH$ddlSeachSchoolID": str(school_id),
         "ctl00$CPH$txtSeachCGP_INDEX": "ALL",
     }
-    resp = aspnet_post(session, cfg.attendance_url, soup,
-                       event_target="ctl00$CPH$btnSeach",
-                       event_argument="",
-                       extra_form=extra)
-    new_soup = BeautifulSoup(resp.text, "lxml")
-    rows = parse_attendance_table(resp.text)
+
+    async def _post(fields: Dict[str, str]) -> bytes:
+        payload = dict(fields)
+        payload.update(extra)
+        async with sem:
+            async with session.post(cfg.attendance_url, data=payload) as resp:
+                resp.raise_for_status()
+                return await resp.read()
+
+    body = await _post(viewstates[key])
+    # 「授業予定はありません」（大半の日）はツリーを作らずに即return
+    if _NO_CLASS_MARKER in body:
+        return [], []
+    # 応答は一度だけツリー化し、各パーサで共有する（bytesのままlxmlへ）
+    tree = _parse(body)
+    if tree.get_element_by_id("TblDataList", None) is None:
+        # キャッシュしたViewStateが拒否された場合のみ、応答の隠しフィールドで更新して一度だけ再試行
+        viewstates[key] = extract_hidden_fields(tree)
+        body = await _post(viewstates[key])
+        if _NO_CLASS_MARKER in body:
+            return [], []
+        tree = _parse(body)
+    rows = parse_attendance_table(tree)
     for r2 in rows:
         r2["date"] = day.isoformat()
         r2["school_id"] = school_id
@@ -542,52 +664,149 @@ def fetch_one_day(session: requests.Session, cfg: Config, soup: BeautifulSoup, d
     # クラス詳細情報を取得（オプション）
     details = []
     if fetch_details:
-        links = fetch_class_detail_links(resp.text, cfg.base_url)
-        print(f"  [DEBUG] 見つかったクラス数: {len(links)}")
+        links = fetch_class_detail_links(tree, cfg.base_url)
+        logger.debug("見つかったクラス数: %d", len(links))
         for class_name, detail_url in links:
             try:
-                print(f"  [DEBUG] アクセス中: {detail_url}")
-                detail_info = fetch_class_detail(session, detail_url)
-                detail_info["date"] = day.isoformat()
-                detail_info["school_id"] = school_id
-                detail_info["course_id"] = course_id
+                logger.debug("アクセス中: %s", detail_url)
+                detail_info = await fetch_class_detail_async(session, sem, detail_url)
+                detail_info.date = day.isoformat()
+                detail_info.school_id = school_id
+                detail_info.course_id = course_id
                 details.append(detail_info)
-                teacher_info = f"講師ID={detail_info['teacher_id']}, 講師名={detail_info['teacher_name']}({detail_info['teacher_attendance']})"
-                if detail_info.get('teacher_memo'):
-                    teacher_info += f" [備考: {detail_info['teacher_memo']}]"
-                print(f"  → {class_name}: {teacher_info}, 生徒出席={detail_info['attendance_count_regular']}, 生徒振替={detail_info['attendance_count_substitution']}, 生徒欠席={detail_info['absent_count']}")
-                time.sleep(0.3)  # サーバーへの負荷を軽減
+                teacher_info = f"講師ID={detail_info.teacher_id}, 講師名={detail_info.teacher_name}({detail_info.teacher_attendance})"
+                if detail_info.teacher_memo:
+                    teacher_info += f" [備考: {detail_info.teacher_memo}]"
+                print(f"  → {class_name}: {teacher_info}, 生徒出席={detail_info.attendance_count_regular}, 生徒振替={detail_info.attendance_count_substitution}, 生徒欠席={detail_info.absent_count}")
             except Exception as e:
                 import traceback
                 print(f"  [WARN] クラス詳細取得エラー {class_name}: {e}")
-                print(f"  [DEBUG] エラー詳細:\n{traceback.format_exc()}")
+                logger.debug("エラー詳細:\n%s", traceback.format_exc())
+
+    return rows, details
+
 
-    return rows, new_soup, details
+async def fetch_course_days_async(cfg: Config, cookies: Dict[str, str], base_fields: Dict[str, str],
+                                  days: List[date], school_ids: List[str], course_id: int,
+                                  fetch_details: bool = False, concurrency: int = 10) -> Tuple[List[dict], List[Detail]]:
+    # 校舎×日付の全組み合わせを同時実行（セマフォで同時リクエスト数を制限）
+    sem = asyncio.Semaphore(concurrency)
+    keys = [(sid, d) for sid in school_ids for d in days]
+    # 初期ページの隠しフィールドを (course_id, school_id) 単位でキャッシュ
+    viewstates: Dict[Tuple[int, str], Dict[str, str]] = {
+        (course_id, sid): dict(base_fields) for sid in school_ids}
+    async with aiohttp.ClientSession(headers={"User-Agent": cfg.user_agent}, cookies=cookies) as session:
+        tasks = [fetch_one_day_async(session, sem, cfg, viewstates, d, course_id, sid, fetch_details)
+                 for sid, d in keys]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+    all_rows: List[dict] = []
+    all_details: List[Detail] = []
+    for (sid, d), result in zip(keys, results):
+        if isinstance(result, BaseException):
+            print(f"[WARN] {d} course_id={course_id}, school_id={sid}: {result}", file=sys.stderr)
+            continue
+        rows, details = result
+        all_rows.extend(rows)
+        all_details.extend(details)
+        print(f"[{d}] course_id={course_id}, school_id={sid} rows={len(rows)}, details={len(details)}")
+    return all_rows, all_details
 
 
-def aggregate_active_slots(rows: List[dict]) -> pd.DataFrame:
-    df = pd.DataFrame(rows)
+def aggregate_active_slots(df: pd.DataFrame) -> pd.DataFrame:
     if df.empty:
         return pd.DataFrame(columns=["date", "school_name", "start_time", "end_time", "has_class"])
-    grp = df.groupby(["date", "school_name", "start_time"], as_index=False).agg({"has_class": "max"})
-    grp["end_time"] = grp["start_time"].apply(map_end_time)
+    # 文字列キーをcategory化してからgroupby（C実装のコードパスに乗せる）
+    work = df[["date", "school_name", "start_time", "has_class"]].copy()
+    for c in ("date", "school_name", "start_time"):
+        work[c] = work[c].astype("category")
+    grp = work.groupby(["date", "school_name", "start_time"],
+                       as_index=False, observed=True, sort=False)["has_class"].any()
+    # 後段（end_timeマップ/Excel出力）のためにキー列は文字列へ戻す
+    for c in ("date", "school_name", "start_time"):
+        grp[c] = grp[c].astype(str)
+    # 終了時刻はユニークな開始時刻に対してのみ計算し、mapで全行へ展開
+    uniq = grp["start_time"].dropna().unique()
+    end_map = {t: map_end_time(t) for t in uniq}
+    grp["end_time"] = grp["start_time"].map(end_map)
     return grp[["date", "school_name", "start_time", "end_time", "has_class"]]
 
 
 def to_tslot(active_df: pd.DataFrame) -> pd.DataFrame:
     if active_df.empty:
         return pd.DataFrame(columns=["slot_date", "campus_name", "slot_start", "slot_end", "memo"])
-    use = active_df[active_df["has_class"] == True].copy()
-    use.rename(columns={
+    use = active_df.loc[active_df["has_class"] == True,
+                        ["date", "school_name", "start_time", "end_time"]].rename(columns={
         "date": "slot_date",
         "school_name": "campus_name",
         "start_time": "slot_start",
         "end_time": "slot_end",
-    }, inplace=True)
+    })
     use["memo"] = "scraped"
     return use[["slot_date", "campus_name", "slot_start", "slot_end", "memo"]]
 
 
+# 生徒詳細がこの行数を超えたらXLSXシートではなくCSV(gzip)に書く
+# （XLSXはセルごとのXMLオーバーヘッドが支配的になり、CSVの方が一桁速い）
+_STUDENT_CSV_THRESHOLD = 50_000
+
+
+def _stream_student_csv(details, csv_path: str) -> None:
+    """Detailのイテレータから生徒1人＝1行のCSV(gzip)を逐次書き出す
+
+    この経路を通るのは閾値超（5万行〜）のランだけなので、テーブル全体を
+    メモリ上に組み立てず、NDJSONの読み戻しに合わせて1クラスずつ書く。
+    """
+    with gzip.open(csv_path, "wt", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(_STUDENT_DETAIL_HEADERS)
+        write_rows = writer.writerows
+        for d in details:
+            write_rows((d.date, d.course_id, d.school_name, d.class_name,
+                        d.teacher_name, s.name, s.student_id, s.status, s.memo)
+                       for s in d.students)
+
+
+# NDJSON読み戻しで値の重複が特に多いキー（校舎名・クラス名・講師名は
+# 全クラス分、日付は1日分のクラス数だけ同じ文字列が現れる）
+_INTERN_KEYS = ("date", "school_name", "class_name", "teacher_name")
+
+
+def _iter_ndjson(path: str):
+    """スピルした詳細NDJSONを1行＝1クラスとしてDetail/Studentへ復元しながら読み戻す
+
+    JSONのデコードは行ごとに新しいstrを割り当てるため、重複の多い親レベルの
+    文字列は sys.intern で1オブジェクトに畳んでメモリとハッシュ計算を節約する。
+    """
+    loads = orjson.loads if orjson is not None else json.loads
+    intern = sys.intern
+    with open(path, "rb") as f:
+        for line in f:
+            data = loads(line)
+            for key in _INTERN_KEYS:
+                value = data.get(key)
+                if type(value) is str:
+                    data[key] = intern(value)
+            data["students"] = [Student(**s) for s in data.get("students") or ()]
+            yield Detail(**data)
+
+
+def _write_frame(ws, df: pd.DataFrame):
+    """DataFrameをヘッダー行＋データ行として行単位でワークシートへ書き込む。
+
+    constant_memory モードは行を昇順にしか書けない（書いた行は即フラッシュされる）。
+    to_excel は列方向にセルを書くためこのモードと両立しないので、
+    write_row で1行ずつ流し込む。
+    """
+    # NaN/NaT は write_number() が拒否して TypeError になるため、
+    # to_excel と同じく空セル（None）に落としてから書く
+    df = df.astype(object).where(df.notna(), None)
+    write_row = ws.write_row  # ループ内の束縛メソッド再探索を省く
+    write_row(0, 0, [str(c) for c in df.columns])
+    for i, row in enumerate(df.itertuples(index=False, name=None), start=1):
+        write_row(i, 0, row)
+
+
 def _chunk(rows: List[dict], size: int = 200) -> List[List[dict]]:
     return [rows[i:i + size] for i in range(0, len(rows), size)]
 
@@ -596,63 +815,86 @@ def normalize_start_time(value: Optional[str]) -> Optional[str]:
     if not value:
         return None
     text = str(value).strip()
-    match = re.search(r"(\d{1,2}:\d{2})", text)
+    match = _START_TIME_RE.search(text)
     if match:
         return match.group(1)
     return text or None
 
 
-def prepare_detail_rows(details: List[dict]) -> List[dict]:
-    prepared = []
-    for detail in details:
-        teacher_id = str(detail.get("teacher_id") or "").strip()
-        teacher_attendance = str(detail.get("teacher_attendance") or "").strip()
-        if not teacher_id:
-            continue
-        if teacher_attendance and "出席" not in teacher_attendance:
-            continue
-        attendance_count = detail.get("attendance_count")
-        try:
-            attendance_total = int(float(attendance_count)) if attendance_count is not None else 0
-        except Exception:
-            attendance_total = 0
-        raw_work_type = detail.get("work_type")
-        if raw_work_type is not None:
-            work_type = str(raw_work_type).strip() or "授業"
-        else:
-            work_type = "授業" if attendance_total > 0 else "待機"
-
-        start_time = normalize_start_time(detail.get("start_time"))
-        prepared.append({
-            "date": detail.get("date"),
-            "school_id": detail.get("school_id"),
-            "school_name": detail.get("school_name"),
-            "class_name": detail.get("class_name"),
-            "course_id": detail.get("course_id"),
-            "start_time": start_time,
-            "teacher_id": teacher_id,
-            "teacher_name": detail.get("teacher_name"),
-            "teacher_attendance": teacher_attendance or '出席',
-            "attendance_count": attendance_total,
-            "work_type": work_type,
-        })
-    return prepared
+# 詳細シートのヘッダー（行ストリームの書き出しで毎回組み立てない）
+_CLASS_DETAIL_HEADERS = (
+    "date", "course_id", "school_name", "school_id", "class_name",
+    "start_time", "teacher_id", "teacher_name", "teacher_attendance",
+    "teacher_memo", "attendance_count", "attendance_count_regular",
+    "attendance_count_substitution", "absent_count", "total_students")
+_STUDENT_DETAIL_HEADERS = (
+    "date", "course_id", "school_name", "class_name", "teacher_name",
+    "student_name", "student_id", "status", "memo")
+
+_DETAIL_ROW_COLUMNS = ["date", "school_id", "school_name", "class_name", "course_id",
+                       "start_time", "teacher_id", "teacher_name", "teacher_attendance",
+                       "attendance_count", "work_type"]
 
 
-def push_to_gas(details: List[dict], webhook_url: str, api_key: str, batch_size: int = 200, timeout: int = 30):
-    """Apps Script Webアプリに講師勤怠データを送信する"""
+def prepare_detail_rows(details: List[Detail]) -> List[dict]:
+    df = pd.DataFrame(details)
+    if df.empty:
+        return []
+    for col in _DETAIL_ROW_COLUMNS:
+        if col not in df.columns:
+            df[col] = None
+
+    # 講師IDなし、または欠席講師の行を除外（元の行単位ループと同じ条件）
+    df["teacher_id"] = df["teacher_id"].fillna("").astype(str).str.strip()
+    df["teacher_attendance"] = df["teacher_attendance"].fillna("").astype(str).str.strip()
+    df = df[(df["teacher_id"] != "") &
+            (df["teacher_attendance"].eq("") | df["teacher_attendance"].str.contains("出席"))].copy()
+    if df.empty:
+        return []
+
+    df["attendance_count"] = pd.to_numeric(df["attendance_count"], errors="coerce").fillna(0).astype(int)
+    stripped_work = df["work_type"].fillna("").astype(str).str.strip().replace("", "授業")
+    df["work_type"] = np.where(df["work_type"].notna(), stripped_work,
+                               np.where(df["attendance_count"] > 0, "授業", "待機"))
+    df["teacher_attendance"] = df["teacher_attendance"].replace("", "出席")
+    # NaN は truthy なので map に渡すと "nan" 文字列になる。欠損はスキップして None のまま残す
+    df["start_time"] = df["start_time"].map(normalize_start_time, na_action="ignore")
+    # 残った NaN は JSON 化できない（stdlib json は不正トークン NaN を吐く）ため None に変換。
+    # app.gs 側も start_time が falsy の行をスキップする前提
+    out = df[_DETAIL_ROW_COLUMNS].astype(object)
+    out = out.where(out.notna(), None)
+    return out.to_dict("records")
+
+
+def push_to_gas(details: List[Detail], webhook_url: str, api_key: str, batch_size: int = 200,
+                timeout: int = 30, max_workers: int = 4):
+    """Apps Script Webアプリに講師勤怠データを送信する（バッチを並列POST）"""
     payload_rows = prepare_detail_rows(details)
     if not payload_rows:
         print("[gas] 送信対象データがありません (講師出席データなし)")
         return
 
     batches = _chunk(payload_rows, batch_size)
-    for idx, batch in enumerate(batches, start=1):
+
+    # バッチ間でコネクションを使い回す（毎回のTLSハンドシェイクを省く）
+    gs = requests.Session()
+    gs.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=max_workers))
+
+    def _send(idx: int, batch: List[dict]):
         payload = {
             "apiKey": api_key,
+            # 再送時にApps Script側で識別できるようチャンク番号を本文に含める
+            # （doPost はリクエストヘッダーを参照できない）
+            "chunkIndex": idx,
             "rows": batch,
         }
-        resp = requests.post(webhook_url, json=payload, timeout=timeout)
+        # JSONはキーが繰り返されて圧縮が良く効くので、gzipで数分の1に縮めて送る。
+        # Apps Script は Content-Encoding: gzip を透過展開せず、バイナリ本文も
+        # 安全に受け取れないため、base64 に包んで app.gs 側で Utilities.ungzip する
+        body = base64.b64encode(gzip.compress(_json_dumps(payload), compresslevel=3))
+        resp = gs.post(webhook_url, data=body,
+                       headers={"Content-Type": "text/plain"},
+                       timeout=timeout)
         try:
             resp.raise_for_status()
         except Exception as e:
@@ -661,6 +903,10 @@ def push_to_gas(details: List[dict], webhook_url: str, api_key: str, batch_size:
             raise
         print(f"[gas] バッチ{idx}/{len(batches)} を送信 status={resp.status_code}")
 
+    # Apps Script側はGoogleへの往復がボトルネックなので、複数バッチを同時に送る
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(batches))) as executor:
+        list(executor.map(lambda ib: _send(*ib), enumerate(batches, start=1)))
+
 
 def load_toml(path: str) -> Optional[dict]:
     if not path or not os.path.exists(path):
@@ -678,11 +924,16 @@ def main():
     ap.add_argument("--school-ids", default="auto", help='例: "1,17,20"。auto=DDLから全取得')
     ap.add_argument("--course-ids", default=None, help='ブランドID（カンマ区切りで複数指定可能）例: "2,145"。未指定なら設定値/既定=145')
     ap.add_argument("--out", default=None, help="出力Excel。未指定は attendance_sessions_YYYYMM.xlsx")
+    ap.add_argument("--format", choices=("xlsx", "csv", "auto"), default="auto",
+                    help="生徒詳細の出力形式。auto=5万行超でcsv.gzに切替")
     ap.add_argument("--skip-workend", action="store_true", help="退勤ボタンのクリックをスキップ")
     ap.add_argument("--fetch-details", action="store_true", help="各クラスの詳細情報（講師名、出席数など）を取得")
     ap.add_argument("--gas-webhook", help="Apps Script WebアプリのURL。指定すると取得結果をGASへPOST")
     ap.add_argument("--gas-api-key", help="Apps Script側で検証するAPIキー (X-GAS-KEY)" )
+    ap.add_argument("--verbose", action="store_true", help="デバッグログを出力")
     args = ap.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING,
+                        format="%(levelname)s %(message)s")
     args.month = resolve_month_arg(args.month)
     print(f"[info] 対象年月: {args.month}")
 
@@ -715,8 +966,7 @@ def main():
 
     print(f"[info] 対象ブランドID: {course_ids}")
 
-    s = requests.Session()
-    s.headers.update({"User-Agent": cfg.user_agent})
+    s = make_session(cfg)
 
     # 1) ログイン
     if not login(s, cfg, verbose=True):
@@ -730,110 +980,176 @@ def main():
             print(f"[WARN] work_end: {e}", file=sys.stderr)
 
     start, end = yyyymm_to_range(args.month)
+    days = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+    yyyymm = args.month.replace("-", "")
+    out_path = args.out or f"attendance_sessions_{yyyymm}.xlsx"
     all_rows: List[dict] = []
-    all_details: List[dict] = []
 
-    # 各course_idに対してループ
-    for course_id in course_ids:
+    def process_course(course_id: int) -> Tuple[List[dict], List[Detail]]:
         print(f"\n[info] ブランドID {course_id} の処理を開始")
 
+        # CookieJarはスレッド間で共有できないため、ブランドごとに独立したセッションでログイン
+        cs = make_session(cfg)
+        if not login(cs, cfg, verbose=False):
+            print(f"[ERROR] course_id={course_id}: ログイン失敗（ヒューリスティック）", file=sys.stderr)
+
         # 3) 生徒出欠簿を開く
-        soup = open_attendance(s, cfg)
+        root = open_attendance(cs, cfg)
 
         # 4) ブランド変更（DDLポストバック）
         try:
-            soup = change_course(s, cfg, soup, course_id)
+            root = change_course(cs, cfg, root, course_id)
         except Exception as e:
             print(f"[WARN] change_course: {e}", file=sys.stderr)
-            continue
+            return [], []
 
         # 5) 校舎リスト
         if args.school_ids.strip().lower() == "auto":
-            opts = parse_school_options_from_soup(soup)
+            opts = parse_school_options_from_soup(root)
             school_ids = [val for val, _ in opts if val.isdigit()]
             print(f"[info] ブランドID {course_id} - 取得した校舎数: {len(school_ids)}")
         else:
             school_ids = [x.strip() for x in args.school_ids.split(",") if x.strip()]
 
-        for sid in school_ids:
-            d = start
-            day_soup = soup  # __VIEWSTATEを保つ
-            while d <= end:
-                try:
-                    rows, day_soup, details = fetch_one_day(s, cfg, day_soup, d, course_id, sid, fetch_details=args.fetch_details)
+        # 6) 校舎×日付を並列で取得（初期ページの隠しフィールドを各POSTで使い回す）
+        base_fields = extract_hidden_fields(root)
+        cookies = {c.name: c.value for c in cs.cookies}
+        return asyncio.run(fetch_course_days_async(
+            cfg, cookies, base_fields, days, school_ids, course_id,
+            fetch_details=args.fetch_details))
+
+    # 詳細はメモリに貯め込まず一時NDJSONへスピルし、出力時に1行ずつ読み戻す
+    # （全詳細dict＋Excelバッファが同時にRSSへ乗るピークを潰す）
+    details_path = f"{out_path}.details.ndjson" if args.fetch_details else None
+    detail_count = 0
+    total_students = 0
+
+    # 各ブランドを並列処理（ブランドごとに独立したセッション＋イベントループ）
+    spill = open(details_path, "wb") if details_path else None
+    # スピルした一時NDJSONは異常終了でも残さない（出力〜送信の全区間を finally で掃除）
+    try:
+        try:
+            with ThreadPoolExecutor(max_workers=len(course_ids)) as executor:
+                for rows, details in executor.map(process_course, course_ids):
                     all_rows.extend(rows)
-                    all_details.extend(details)
-                    print(f"[{d}] course_id={course_id}, school_id={sid} rows={len(rows)}, details={len(details)}")
-                    time.sleep(0.2)
-                except Exception as e:
-                    print(f"[WARN] {d} course_id={course_id}, school_id={sid}: {e}", file=sys.stderr)
-                d += timedelta(days=1)
-
-    raw_df = pd.DataFrame(all_rows)
-    active_df = aggregate_active_slots(all_rows)
-    tslot_df = to_tslot(active_df)
-
-    yyyymm = args.month.replace("-", "")
-    out_path = args.out or f"attendance_sessions_{yyyymm}.xlsx"
-    with pd.ExcelWriter(out_path, engine="openpyxl") as xw:
-        raw_df.to_excel(xw, sheet_name="Raw", index=False)
-        active_df.to_excel(xw, sheet_name="ActiveSlots", index=False)
-        tslot_df.to_excel(xw, sheet_name="T_Slot", index=False)
-
-        # 詳細情報シートを追加
-        if all_details:
-            # 生徒情報を展開せずに集計情報のみを出力
-            details_summary = []
-            for detail in all_details:
-                details_summary.append({
-                    "date": detail.get("date"),
-                    "course_id": detail.get("course_id"),
-                    "school_name": detail.get("school_name"),
-                    "school_id": detail.get("school_id"),
-                    "class_name": detail.get("class_name"),
-                    "start_time": detail.get("start_time"),
-                    "teacher_id": detail.get("teacher_id"),
-                    "teacher_name": detail.get("teacher_name"),
-                    "teacher_attendance": detail.get("teacher_attendance"),
-                    "teacher_memo": detail.get("teacher_memo"),
-                    "attendance_count": detail.get("attendance_count"),
-                    "attendance_count_regular": detail.get("attendance_count_regular"),
-                    "attendance_count_substitution": detail.get("attendance_count_substitution"),
-                    "absent_count": detail.get("absent_count"),
-                    "total_students": len(detail.get("students", [])),
-                })
-            details_df = pd.DataFrame(details_summary)
-            details_df.to_excel(xw, sheet_name="ClassDetails", index=False)
-
-            # 生徒詳細情報も別シートに出力
-            student_details = []
-            for detail in all_details:
-                for student in detail.get("students", []):
-                    student_details.append({
-                        "date": detail.get("date"),
-                        "course_id": detail.get("course_id"),
-                        "school_name": detail.get("school_name"),
-                        "class_name": detail.get("class_name"),
-                        "teacher_name": detail.get("teacher_name"),
-                        "student_name": student.get("name"),
-                        "student_id": student.get("student_id"),
-                        "status": student.get("status"),
-                        "memo": student.get("memo"),
-                    })
-            if student_details:
-                students_df = pd.DataFrame(student_details)
-                students_df.to_excel(xw, sheet_name="StudentDetails", index=False)
-
-    print(f"[OK] Exported: {out_path}")
-
-    gas_webhook = args.gas_webhook or os.environ.get("GAS_WEBHOOK")
-    gas_api_key = args.gas_api_key or os.environ.get("GAS_API_KEY")
-    if gas_webhook:
-        if not gas_api_key:
-            raise SystemExit("GAS 連携には GAS_API_KEY (環境変数または --gas-api-key) を指定してください")
-        if not args.fetch_details:
-            raise SystemExit("GAS 連携には --fetch-details を指定して ClassDetails を取得してください")
-        push_to_gas(all_details, gas_webhook, gas_api_key)
+                    for detail in details:
+                        spill.write(_json_dumps(detail))
+                        spill.write(b"\n")
+                        detail_count += 1
+                        total_students += len(detail.students)
+        finally:
+            if spill is not None:
+                spill.close()
+
+        raw_df = pd.DataFrame(all_rows)
+        active_df = aggregate_active_slots(raw_df)
+        tslot_df = to_tslot(active_df)
+
+        students_to_csv = args.format == "csv" or (
+            args.format == "auto" and total_students > _STUDENT_CSV_THRESHOLD)
+
+        # 生徒CSVの生成はワークブックの書き出しと完全に独立なので、別スレッドで重ねて走らせる
+        # （ワークブック自体は共有文字列テーブルがスレッド安全でないため1スレッドで書く）
+        csv_path = None
+        csv_future = None
+        side_pool = None
+        if detail_count and students_to_csv and total_students:
+            csv_path = os.path.splitext(out_path)[0] + ".students.csv.gz"
+            side_pool = ThreadPoolExecutor(max_workers=1)
+            csv_future = side_pool.submit(
+                _stream_student_csv, _iter_ndjson(details_path), csv_path)
+        # constant_memory: 行を逐次フラッシュし、Rawシートが数万行でもメモリをほぼ一定に保つ
+        # strings_to_formulas/urls=False: 文字列セルごとの数式・URL判定を省く
+        # strings_to_numbers=False: 文字列→数値の暗黙変換もしない（時刻文字列を保持）
+        with pd.ExcelWriter(out_path, engine="xlsxwriter",
+                            engine_kwargs={"options": {"constant_memory": True,
+                                                       "strings_to_formulas": False,
+                                                       "strings_to_urls": False,
+                                                       "strings_to_numbers": False}}) as xw:
+            book = xw.book
+            _write_frame(book.add_worksheet("Raw"), raw_df)
+            _write_frame(book.add_worksheet("ActiveSlots"), active_df)
+            _write_frame(book.add_worksheet("T_Slot"), tslot_df)
+
+            # 詳細情報シートを追加（スピル済みNDJSONをストリームで読み戻す）
+            if detail_count:
+                # 生徒情報を展開せずに集計情報のみを出力。
+                # プレーンな表出力なのでDataFrameを経由せず、dictから直接セルへ書き込む
+                # （DataFrame構築とブロック統合のコストを丸ごと省く）
+                ws = book.add_worksheet("ClassDetails")
+                ws.write_row(0, 0, _CLASS_DETAIL_HEADERS)
+                # 生徒詳細情報も別シートに出力（クラスごとに行カウンタを進めながら展開）。
+                # 生徒が1人もいなければシート自体を作らず、行数が多いときはCSVへ逃がす
+                sws = None
+                if total_students and not students_to_csv:
+                    sws = book.add_worksheet("StudentDetails")
+                    sws.write_row(0, 0, _STUDENT_DETAIL_HEADERS)
+                # constant_memory は「各シート内で行が昇順」なら複数シートの
+                # 交互書き込みを許すので、詳細を1回なめるだけで両シートを埋める。
+                # write_row はローカルに束縛して属性探索を行ごとに繰り返さない
+                write_class_row = ws.write_row
+                write_student_row = sws.write_row if sws is not None else None
+                sr = 1
+                for r, detail in enumerate(_iter_ndjson(details_path), start=1):
+                    date = detail.date
+                    course_id = detail.course_id
+                    school_name = detail.school_name
+                    class_name = detail.class_name
+                    teacher_name = detail.teacher_name
+                    students = detail.students
+                    write_class_row(r, 0, (
+                        date,
+                        course_id,
+                        school_name,
+                        detail.school_id,
+                        class_name,
+                        detail.start_time,
+                        detail.teacher_id,
+                        teacher_name,
+                        detail.teacher_attendance,
+                        detail.teacher_memo,
+                        # 数値列はNoneを0に寄せて常に数値セルとして書く（空白セル判定を挟まない）
+                        detail.attendance_count or 0,
+                        detail.attendance_count_regular or 0,
+                        detail.attendance_count_substitution or 0,
+                        detail.absent_count or 0,
+                        len(students),
+                    ))
+                    if write_student_row is None:
+                        continue
+                    for student in students:
+                        write_student_row(sr, 0, (
+                            date,
+                            course_id,
+                            school_name,
+                            class_name,
+                            teacher_name,
+                            student.name,
+                            student.student_id,
+                            student.status,
+                            student.memo,
+                        ))
+                        sr += 1
+
+        print(f"[OK] Exported: {out_path}")
+
+        if csv_future is not None:
+            csv_future.result()
+            side_pool.shutdown()
+            print(f"[OK] StudentDetails: {csv_path} ({total_students}行)")
+
+        gas_webhook = args.gas_webhook or os.environ.get("GAS_WEBHOOK")
+        gas_api_key = args.gas_api_key or os.environ.get("GAS_API_KEY")
+        if gas_webhook:
+            if not gas_api_key:
+                raise SystemExit("GAS 連携には GAS_API_KEY (環境変数または --gas-api-key) を指定してください")
+            if not args.fetch_details:
+                raise SystemExit("GAS 連携には --fetch-details を指定して ClassDetails を取得してください")
+            push_to_gas(list(_iter_ndjson(details_path)), gas_webhook, gas_api_key)
+
+    finally:
+        if details_path and os.path.exists(details_path):
+            os.remove(details_path)
 
 
 if __name__ == "__main__":